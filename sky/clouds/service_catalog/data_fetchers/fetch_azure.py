@@ -3,17 +3,27 @@
 This script takes about 1 minute to finish.
 """
 import argparse
+import concurrent.futures
+import itertools
 import json
-from multiprocessing import pool as mp_pool
 import os
 import subprocess
 from typing import List, Optional, Set
 import urllib
 
-import numpy as np
 import pandas as pd
 import requests
 
+# orjson/ujson parse the raw response bytes directly and are considerably
+# faster than the stdlib json; fall back gracefully when not installed.
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
 US_REGIONS = [
     'centralus',
     'eastus',
@@ -45,7 +55,7 @@ def get_regions() -> List[str]:
         shell=True,
         check=True,
         stdout=subprocess.PIPE)
-    items = json.loads(proc.stdout.decode('utf-8'))
+    items = _json.loads(proc.stdout)
     regions = [
         item['RegionName']
         for item in items
@@ -63,20 +73,88 @@ USEFUL_COLUMNS = [
     'GpuInfo', 'Price', 'SpotPrice', 'Region', 'Generation', 'DeviceMemory'
 ]
 
+# Map of Azure's machines with GPU to their corresponding GPU memory (in GB).
+# The values are hard-coded since Azure's API does not return such info; they
+# may be outdated so need to be maintained.
+GPU_MEMORY_MAP = {
+    'Standard_NC6': 12,
+    'Standard_NC12': 24,
+    'Standard_NC24': 48,
+    'Standard_NC24r*': 48,
+    'Standard_NC6s_v2': 16,
+    'Standard_NC12s_v2': 32,
+    'Standard_NC24s_v2': 64,
+    'Standard_NC24rs_v2*': 64,
+    'Standard_NC6s_v3': 16,
+    'Standard_NC12s_v3': 32,
+    'Standard_NC24s_v3': 32,
+    'Standard_NC4as_T4_v3': 16,
+    'Standard_NC8as_T4_v3': 16,
+    'Standard_NC16as_T4_v3': 16,
+    'Standard_NC64as_T4_v3': 64,
+    'Standard_NC24ads_A100_v4': 80,
+    'Standard_NC48ads_A100_v4': 160,
+    'Standard_NC96ads_A100_v4': 320,
+    'Standard_ND96asr_v4': 40,
+    'Standard_ND96amsr_A100_v4': 80,
+    'Standard_ND6s': 24,
+    'Standard_ND12s': 48,
+    'Standard_ND24s': 96,
+    'Standard_ND24rs*': 96,
+    'Standard_ND40rs_v2': 32,
+    'Standard_NG8ads_V620_v1': 8,
+    'Standard_NG16ads_V620_v1': 16,
+    'Standard_NG32ads_V620_v1': 32,
+    'Standard_NG32adms_V620_v1': 32,
+    'Standard_NV6': 8,
+    'Standard_NV12': 16,
+    'Standard_NV24': 32,
+    'Standard_NV12s_v3': 8,
+    'Standard_NV24s_v3': 16,
+    'Standard_NV48s_v3': 32,
+    'Standard_NV4as_v4': 2,
+    'Standard_NV8as_v4': 4,
+    'Standard_NV16as_v4': 8,
+    'Standard_NV32as_v4': 16,
+    'Standard_NV6ads_A10_v5': 4,
+    'Standard_NV12ads_A10_v5': 8,
+    'Standard_NV18ads_A10_v5': 12,
+    'Standard_NV36ads_A10_v5': 24,
+    'Standard_NV36adms_A10_v5': 24,
+    'Standard_NV72ads_A10_v5': 48,
+    'Standard_NV6_Promo': 16,
+    'Standard_NV12_Promo': 32,
+    'Standard_NV24_Promo': 48,
+}
+
+
+# The constant part of the pricing API filter, quoted once at import time
+# instead of being re-joined and re-quoted for every region.
+_PRICING_FILTER_PREFIX = urllib.parse.quote(
+    'serviceName eq \'Virtual Machines\' and priceType eq \'Consumption\'')
+
 
 def get_pricing_url(region: Optional[str] = None) -> str:
-    filters = [
-        'serviceName eq \'Virtual Machines\'',
-        'priceType eq \'Consumption\'',
-    ]
+    filters_str = _PRICING_FILTER_PREFIX
     if region is not None:
-        filters.append(f'armRegionName eq \'{region}\'')
-    filters_str = urllib.parse.quote(' and '.join(filters))
+        filters_str += urllib.parse.quote(f' and armRegionName eq \'{region}\'')
     return f'https://prices.azure.com/api/retail/prices?$filter={filters_str}'
 
 
-def get_pricing_df(region: Optional[str] = None) -> pd.DataFrame:
+# A shared session reuses TCP/TLS connections across the hundreds of
+# paginated pricing requests, instead of a fresh handshake per page.
+_pricing_session = requests.Session()
+_pricing_session.mount(
+    'https://',
+    requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64))
+
+
+def get_pricing_items(region: Optional[str] = None) -> List[dict]:
     all_items = []
+    # Pagination can overlap, returning the same price entry on two
+    # consecutive pages; dedup at ingest instead of a full-row
+    # drop_duplicates over the concatenated frame later.
+    seen: Set[tuple] = set()
     url = get_pricing_url(region)
     print(f'Getting pricing for {region}')
     page = 0
@@ -84,33 +162,66 @@ def get_pricing_df(region: Optional[str] = None) -> pd.DataFrame:
         page += 1
         if page % 10 == 0:
             print(f'Fetched pricing pages {page}')
-        r = requests.get(url)
+        r = _pricing_session.get(url)
         r.raise_for_status()
-        content_str = r.content.decode('ascii')
-        content = json.loads(content_str)
+        content = _json.loads(r.content)
         items = content.get('Items', [])
         if len(items) == 0:
             break
-        all_items += items
+        for item in items:
+            # Windows SKUs and zero-price entries are never used; drop them
+            # at parse time so they are not materialized in the DataFrame
+            # (Windows items are a large fraction of the price catalog).
+            if item.get('unitPrice', 0) <= 0:
+                continue
+            if ' Windows' in item.get('productName', ''):
+                continue
+            key = (item['armSkuName'], item['armRegionName'],
+                   item['skuName'], item['unitPrice'])
+            if key in seen:
+                continue
+            seen.add(key)
+            all_items.append(item)
         url = content.get('NextPageLink')
     print(f'Done fetching pricing {region}')
-    df = pd.DataFrame(all_items)
-    assert 'productName' in df.columns, (region, df.columns)
-    return df[(~df['productName'].str.contains(' Windows')) &
-              (df['unitPrice'] > 0)]
+    return all_items
+
+
+def _sku_items_to_df(items: List[dict]) -> pd.DataFrame:
+    """Builds the SKU frame, pivoting `capabilities` into flat columns.
+
+    Pivoting the per-SKU list-of-dicts into one column per capability name
+    at ingest means downstream processing never iterates the nested dicts
+    in Python.
+    """
+    df = pd.DataFrame(items)
+    df = df.astype({'name': 'string[pyarrow]', 'Region': 'string[pyarrow]'})
+    caps = df.pop('capabilities').explode().dropna()
+    caps_df = pd.json_normalize(caps).set_index(caps.index)
+    caps_df = caps_df.pivot_table(index=caps_df.index,
+                                  columns='name',
+                                  values='value',
+                                  aggfunc='first')
+    caps_df = caps_df.reindex(index=df.index,
+                              columns=['GPUs', 'vCPUs', 'MemoryGB',
+                                       'HyperVGenerations'])
+    return pd.concat([df, caps_df], axis='columns')
 
 
 def get_sku_df(region_set: Set[str]) -> pd.DataFrame:
     print('Fetching SKU list')
     # To get a complete list, --all option is necessary.
+    # Let the az CLI drop SKUs without a location before the (tens of MB of)
+    # JSON ever reaches Python.
     proc = subprocess.run(
-        'az vm list-skus --all --resource-type virtualMachines -o json',
+        'az vm list-skus --all --resource-type virtualMachines '
+        '--query "[?locations[0] != null]" -o json',
         shell=True,
         check=True,
         stdout=subprocess.PIPE,
     )
     print('Done fetching SKUs')
-    items = json.loads(proc.stdout.decode('ascii'))
+    items = _json.loads(proc.stdout)
     filtered_items = []
     for item in items:
         # zones = item['locationInfo'][0]['zones']
@@ -120,55 +231,72 @@ def get_sku_df(region_set: Set[str]) -> pd.DataFrame:
         item['Region'] = region
         filtered_items.append(item)
 
-    df = pd.DataFrame(filtered_items)
-    return df
-
-
-def get_gpu_name(family: str) -> Optional[str]:
-    gpu_data = {
-        'standardNCFamily': 'K80',
-        'standardNCSv2Family': 'P100',
-        'standardNCSv3Family': 'V100',
-        'standardNCPromoFamily': 'K80',
-        'StandardNCASv3_T4Family': 'T4',
-        'standardNDSv2Family': 'V100-32GB',
-        'StandardNCADSA100v4Family': 'A100-80GB',
-        'standardNDAMSv4_A100Family': 'A100-80GB',
-        'StandardNDASv4_A100Family': 'A100',
-        'standardNVFamily': 'M60',
-        'standardNVSv2Family': 'M60',
-        'standardNVSv3Family': 'M60',
-        'standardNVPromoFamily': 'M60',
-        'standardNVSv4Family': 'Radeon MI25',
-        'standardNDSFamily': 'P40',
-        'StandardNVADSA10v5Family': 'A10',
-    }
-    # NP-series offer Xilinx U250 FPGAs which are not GPUs,
-    # so we do not include them here.
-    # https://docs.microsoft.com/en-us/azure/virtual-machines/np-series
-    family = family.replace(' ', '')
-    return gpu_data.get(family)
+    return _sku_items_to_df(filtered_items)
+
+
+# Map of SKU family (with spaces removed) to the GPU name it carries.
+# NP-series offer Xilinx U250 FPGAs which are not GPUs,
+# so we do not include them here.
+# https://docs.microsoft.com/en-us/azure/virtual-machines/np-series
+GPU_FAMILY_TO_NAME = {
+    'standardNCFamily': 'K80',
+    'standardNCSv2Family': 'P100',
+    'standardNCSv3Family': 'V100',
+    'standardNCPromoFamily': 'K80',
+    'StandardNCASv3_T4Family': 'T4',
+    'standardNDSv2Family': 'V100-32GB',
+    'StandardNCADSA100v4Family': 'A100-80GB',
+    'standardNDAMSv4_A100Family': 'A100-80GB',
+    'StandardNDASv4_A100Family': 'A100',
+    'standardNVFamily': 'M60',
+    'standardNVSv2Family': 'M60',
+    'standardNVSv3Family': 'M60',
+    'standardNVPromoFamily': 'M60',
+    'standardNVSv4Family': 'Radeon MI25',
+    'standardNDSFamily': 'P40',
+    'StandardNVADSA10v5Family': 'A10',
+}
 
 
 def get_all_regions_instance_types_df(region_set: Set[str]):
     if SINGLE_THREADED:
-        dfs = [get_pricing_df(region) for region in region_set]
+        results = [get_pricing_items(region) for region in region_set]
         df_sku = get_sku_df(region_set)
-        df = pd.concat(dfs)
     else:
-        with mp_pool.Pool() as pool:
-            dfs_result = pool.map_async(get_pricing_df, region_set)
-            df_sku_result = pool.apply_async(get_sku_df, (region_set,))
-
-            dfs = dfs_result.get()
-            df_sku = df_sku_result.get()
-            df = pd.concat(dfs)
-
-    print('Processing dataframes')
-    df.drop_duplicates(inplace=True)
-
-    df = df[df['unitPrice'] > 0]
-
+        # The fetches are blocking I/O, so threads overlap them just as well
+        # as processes, without forking or pickling the results back to the
+        # parent (and without the SSL issues multiprocessing has with the
+        # azure client).
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(32, len(region_set) + 1)) as executor:
+            df_sku_future = executor.submit(get_sku_df, region_set)
+            results = list(executor.map(get_pricing_items, region_set))
+            df_sku = df_sku_future.result()
+
+    # Build a single frame from the flat item list, instead of one frame
+    # per region followed by a concat: dtype inference and column alignment
+    # then happen only once.
+    all_items = list(itertools.chain.from_iterable(results))
+    # Materialize only the columns we actually use, with fixed dtypes:
+    # from_records then skips inference (and storage) for the ~20 other
+    # keys each pricing item carries.
+    # Arrow-backed strings are several times smaller than object dtype and
+    # run the downstream .str operations over Arrow buffers in C.
+    df = pd.DataFrame.from_records(all_items,
+                                   columns=[
+                                       'armSkuName', 'armRegionName',
+                                       'skuName', 'productName', 'unitPrice'
+                                   ])
+    df = df.astype({
+        'armSkuName': 'string[pyarrow]',
+        'armRegionName': 'string[pyarrow]',
+        'skuName': 'string[pyarrow]',
+        'productName': 'string[pyarrow]',
+        'unitPrice': 'float64',
+    })
+
+    # Windows/zero-price items are already filtered out at parse time, so
+    # the frame can be used as-is without another filtering pass.
     print('Getting price df')
     df['merge_name'] = df['armSkuName']
     # Use lower case for the Region, as for westus3, the SKU API returns
@@ -181,18 +309,12 @@ def get_all_regions_instance_types_df(region_set: Set[str]):
     df.rename(columns={
         'armSkuName': 'InstanceType',
     }, inplace=True)
-    demand_df = df[~df['skuName'].str.contains(' Spot')][[
-        'is_promo', 'InstanceType', 'Region', 'unitPrice'
-    ]]
-    spot_df = df[df['skuName'].str.contains(' Spot')][[
-        'is_promo', 'InstanceType', 'Region', 'unitPrice'
-    ]]
-
-    demand_df.set_index(['InstanceType', 'Region', 'is_promo'], inplace=True)
-    spot_df.set_index(['InstanceType', 'Region', 'is_promo'], inplace=True)
-
-    demand_df = demand_df.rename(columns={'unitPrice': 'Price'})
-    spot_df = spot_df.rename(columns={'unitPrice': 'SpotPrice'})
+    # Scan the skuName column only once: ' Spot' is always a suffix, so
+    # endswith suffices and is cheaper than a contains scan per subframe.
+    is_spot = df['skuName'].str.endswith(' Spot')
+    price_columns = ['is_promo', 'InstanceType', 'Region', 'unitPrice']
+    demand_df = df.loc[~is_spot, price_columns]
+    spot_df = df.loc[is_spot, price_columns]
 
     print('Getting sku df')
     df_sku['is_promo'] = df_sku['name'].str.endswith('_Promo')
@@ -200,122 +322,59 @@ def get_all_regions_instance_types_df(region_set: Set[str]):
 
     df_sku['merge_name'] = df_sku['InstanceType'].str.replace('_Promo', '')
     df_sku['Region'] = df_sku['Region'].str.lower()
+    df_sku['family'] = df_sku['family'].astype('category')
+
+    # Categoricalize the string join keys with a dtype shared by both sides,
+    # so the joins below hash integer codes instead of repeated strings.
+    for price_key, sku_key in (('InstanceType', 'merge_name'), ('Region',
+                                                               'Region')):
+        union = pd.api.types.union_categoricals([
+            demand_df[price_key].astype('category'),
+            spot_df[price_key].astype('category'),
+            df_sku[sku_key].astype('category'),
+        ])
+        dtype = pd.CategoricalDtype(union.categories)
+        demand_df[price_key] = demand_df[price_key].astype(dtype)
+        spot_df[price_key] = spot_df[price_key].astype(dtype)
+        df_sku[sku_key] = df_sku[sku_key].astype(dtype)
+
+    demand_df.set_index(['InstanceType', 'Region', 'is_promo'], inplace=True)
+    spot_df.set_index(['InstanceType', 'Region', 'is_promo'], inplace=True)
+
+    demand_df = demand_df.rename(columns={'unitPrice': 'Price'})
+    spot_df = spot_df.rename(columns={'unitPrice': 'SpotPrice'})
 
     print('Joining')
-    df = df_sku.join(demand_df,
+    # The demand and spot frames share the same MultiIndex, so combine them
+    # once and probe the SKU keys a single time instead of two sequential
+    # joins over the same keys.
+    prices_df = demand_df.join(spot_df, how='outer')
+    df = df_sku.join(prices_df,
                      on=['merge_name', 'Region', 'is_promo'],
                      how='left')
-    df = df.join(spot_df, on=['merge_name', 'Region', 'is_promo'], how='left')
-
-    def get_capabilities(row):
-        gpu_name = None
-        gpu_count = np.nan
-        vcpus = np.nan
-        memory = np.nan
-        gen_version = None
-        caps = row['capabilities']
-        for item in caps:
-            assert isinstance(item, dict), (item, caps)
-            if item['name'] == 'GPUs':
-                gpu_name = get_gpu_name(row['family'])
-                if gpu_name is not None:
-                    gpu_count = item['value']
-            elif item['name'] == 'vCPUs':
-                vcpus = float(item['value'])
-            elif item['name'] == 'MemoryGB':
-                memory = item['value']
-            elif item['name'] == 'HyperVGenerations':
-                gen_version = item['value']
-        return gpu_name, gpu_count, vcpus, memory, gen_version
-
-    def get_additional_columns(row):
-        gpu_name, gpu_count, vcpus, memory, gen_version = get_capabilities(row)
-        return pd.Series({
-            'AcceleratorName': gpu_name,
-            'AcceleratorCount': gpu_count,
-            'vCPUs': vcpus,
-            'MemoryGiB': memory,
-            'GpuInfo': gpu_name,
-            'Generation': gen_version,
-        })
-
-    df_ret = pd.concat(
-        [df, df.apply(get_additional_columns, axis='columns')],
-        axis='columns',
-    )
 
-    def create_gpu_map(df):
-        # Map of Azure's machine with GPU to their corresponding memory
-        # Result is hard-coded since Azure's API to not return such info
-        # may be outdated so need to be maintained
-        gpu_map = {
-            'Standard_NC6': 12,
-            'Standard_NC12': 24,
-            'Standard_NC24': 48,
-            'Standard_NC24r*': 48,
-            'Standard_NC6s_v2': 16,
-            'Standard_NC12s_v2': 32,
-            'Standard_NC24s_v2': 64,
-            'Standard_NC24rs_v2*': 64,
-            'Standard_NC6s_v3': 16,
-            'Standard_NC12s_v3': 32,
-            'Standard_NC24s_v3': 32,
-            'Standard_NC4as_T4_v3': 16,
-            'Standard_NC8as_T4_v3': 16,
-            'Standard_NC16as_T4_v3': 16,
-            'Standard_NC64as_T4_v3': 64,
-            'Standard_NC24ads_A100_v4': 80,
-            'Standard_NC48ads_A100_v4': 160,
-            'Standard_NC96ads_A100_v4': 320,
-            'Standard_ND96asr_v4': 40,
-            'Standard_ND96amsr_A100_v4': 80,
-            'Standard_ND6s': 24,
-            'Standard_ND12s': 48,
-            'Standard_ND24s': 96,
-            'Standard_ND24rs*': 96,
-            'Standard_ND40rs_v2': 32,
-            'Standard_NG8ads_V620_v1': 8,
-            'Standard_NG16ads_V620_v1': 16,
-            'Standard_NG32ads_V620_v1': 32,
-            'Standard_NG32adms_V620_v1': 32,
-            'Standard_NV6': 8,
-            'Standard_NV12': 16,
-            'Standard_NV24': 32,
-            'Standard_NV12s_v3': 8,
-            'Standard_NV24s_v3': 16,
-            'Standard_NV48s_v3': 32,
-            'Standard_NV4as_v4': 2,
-            'Standard_NV8as_v4': 4,
-            'Standard_NV16as_v4': 8,
-            'Standard_NV32as_v4': 16,
-            'Standard_NV6ads_A10_v5': 4,
-            'Standard_NV12ads_A10_v5': 8,
-            'Standard_NV18ads_A10_v5': 12,
-            'Standard_NV36ads_A10_v5': 24,
-            'Standard_NV36adms_A10_v5': 24,
-            'Standard_NV72ads_A10_v5': 48,
-            'Standard_NV6_Promo': 16,
-            'Standard_NV12_Promo': 32,
-            'Standard_NV24_Promo': 48
-        }
-
-        all_instance = df.InstanceType.unique()
-
-        for instance in all_instance:
-            if instance not in gpu_map:
-                gpu_map[instance] = ''
-        return gpu_map
-
-    def map_device_memory(row, dic):
-        return dic[row]
+    # The capability columns were already pivoted out of the nested
+    # `capabilities` dicts by get_sku_df.
+    gpu_name = df['family'].str.replace(' ', '',
+                                        regex=False).map(GPU_FAMILY_TO_NAME)
+    gpu_count = pd.to_numeric(df['GPUs'], errors='coerce')
+
+    df_ret = df.assign(
+        AcceleratorName=gpu_name,
+        AcceleratorCount=gpu_count.where(gpu_name.notna()),
+        vCPUs=pd.to_numeric(df['vCPUs'], errors='coerce'),
+        MemoryGiB=df['MemoryGB'],
+        GpuInfo=gpu_name,
+        Generation=df['HyperVGenerations'],
+    )
 
     before_drop_len = len(df_ret)
     df_ret.dropna(subset=['InstanceType'], inplace=True, how='all')
     after_drop_len = len(df_ret)
     print(f'Dropped {before_drop_len - after_drop_len} duplicated rows')
 
-    df_ret['DeviceMemory'] = df_ret.InstanceType.apply(
-        map_device_memory, args=(create_gpu_map(df_ret),))
+    df_ret['DeviceMemory'] = df_ret['InstanceType'].map(
+        GPU_MEMORY_MAP).fillna('')
 
     # Filter out deprecated families
     df_ret = df_ret.loc[~df_ret['family'].isin(DEPRECATED_FAMILIES)]
@@ -325,7 +384,6 @@ def get_all_regions_instance_types_df(region_set: Set[str]):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-<<<<<<< HEAD
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--all-regions',
                        action='store_true',
@@ -338,10 +396,9 @@ if __name__ == '__main__':
                         help='Exclude the list of specified regions.')
     parser.add_argument('--single-threaded',
                         action='store_true',
-                        help='Run in single-threaded mode. This is useful when '
-                        'running in github action, as the multiprocessing '
-                        'does not work well with the azure client due '
-                        'to ssl issues.')
+                        help='Run in single-threaded mode. This is useful '
+                        'for debugging, e.g. when running in github '
+                        'action.')
     args = parser.parse_args()
 
     SINGLE_THREADED = args.single_threaded
@@ -351,22 +408,12 @@ if __name__ == '__main__':
     elif args.all_regions:
         region_filter = set(get_regions()) - EXCLUDED_REGIONS
     else:
-        region_filter = US_REGIONS
+        region_filter = set(US_REGIONS)
     region_filter = region_filter - set(
         args.exclude) if args.exclude else region_filter
 
     if not region_filter:
         raise ValueError('No regions to fetch. Please check your arguments.')
-=======
-    parser.add_argument(
-        '--all-regions',
-        action='store_true',
-        help='Fetch all global regions, not just the U.S. ones.')
-    args = parser.parse_args()
-
-    region_filter = get_regions() if args.all_regions else US_REGIONS
-    region_filter = set(region_filter) - EXCLUDED_REGIONS
->>>>>>> AddDeviceMemory
 
     instance_df = get_all_regions_instance_types_df(region_filter)
     os.makedirs('azure', exist_ok=True)